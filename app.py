@@ -1,14 +1,18 @@
 import streamlit as st
-import ephem
-import google.generativeai as genai
-import math
-from geopy.geocoders import Nominatim
 import datetime
 import time
-import pandas as pd
-from fpdf import FPDF
 import json
 import os
+import tempfile
+try:
+    import orjson  # optional: much faster profile DB (de)serialization
+except ImportError:
+    orjson = None
+from destiny_core import (
+    PROMPT_TEMPLATE, get_lat_lon, calculate_natal, calculate_transits,
+    load_knowledge_base, create_pdf, get_model, stream_text, start_chat, stream_chat,
+    chat_stop_reason, drop_last_turn
+)
 
 # --- CONFIGURATION ---
 st.set_page_config(page_title="Destiny Dossier", page_icon="🔮", layout="wide")
@@ -17,36 +21,60 @@ st.title("🔮 The Destiny Dossier: Memory Edition")
 # --- DATABASE MANAGEMENT (JSON) ---
 DB_FILE = "profiles.json"
 
+# Profiles are stored as {name: {"dob", "tob", "city"}} so lookups and
+# updates are by key; the old list-of-entries layout is migrated on read
+@st.cache_data(show_spinner=False, max_entries=1)
+def read_profiles(db_version):
+    # db_version (mtime, size) is only the cache key: reparse when the file changes.
+    # Only the current version is worth keeping, so older copies are evicted
+    with open(DB_FILE, "rb") as f:
+        raw = f.read()
+    data = orjson.loads(raw) if orjson else json.loads(raw)
+    if isinstance(data, list):
+        data = {p["name"]: {k: v for k, v in p.items() if k != "name"} for p in data}
+    return data
+
 def load_profiles():
     if not os.path.exists(DB_FILE):
-        return []
+        return {}
     try:
-        with open(DB_FILE, "r") as f:
-            return json.load(f)
-    except:
-        return []
+        stat = os.stat(DB_FILE)
+        return read_profiles((stat.st_mtime_ns, stat.st_size))
+    except (ValueError, OSError) as e:
+        # ValueError covers json's and orjson's JSONDecodeError and the
+        # UnicodeDecodeError stdlib json raises on non-UTF-8 bytes
+        st.warning(f"Profile DB unreadable: {e}")
+        return {}
 
-def save_profile(name, dob, tob_str, city):
-    profiles = load_profiles()
-    # Check if profile exists and update it, or append new
-    new_entry = {
-        "name": name,
+def save_profile(name, dob, tob_str, city, profiles=None):
+    # Callers that already hold the loaded profiles pass them in to skip a reload
+    profiles = load_profiles() if profiles is None else profiles
+    # Insert or overwrite by name (Update logic)
+    profiles[name] = {
         "dob": dob.strftime("%Y-%m-%d"),
         "tob": tob_str,
         "city": city
     }
-    # Remove existing if name matches (Update logic)
-    profiles = [p for p in profiles if p["name"] != name]
-    profiles.append(new_entry)
     
-    with open(DB_FILE, "w") as f:
-        json.dump(profiles, f, indent=4)
+    # Write compact JSON to a uniquely named temp file and swap it in
+    # atomically, so concurrent saves never share a half-written file
+    if orjson:
+        payload = orjson.dumps(profiles)
+    else:
+        payload = json.dumps(profiles, separators=(",", ":")).encode("utf-8")
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(DB_FILE)),
+                                     suffix=".tmp", delete=False) as f:
+        f.write(payload)
+    os.chmod(f.name, 0o644)  # NamedTemporaryFile creates 0600
+    os.replace(f.name, DB_FILE)
 
 # --- SESSION STATE ---
 if "messages" not in st.session_state:
     st.session_state.messages = []
 if "context" not in st.session_state:
     st.session_state.context = None
+if "chat" not in st.session_state:
+    st.session_state.chat = None
 
 # --- SIDEBAR: INPUTS & PROFILES ---
 with st.sidebar:
@@ -54,7 +82,7 @@ with st.sidebar:
     
     # LOAD EXISTING PROFILE
     existing_profiles = load_profiles()
-    profile_names = ["-- New Profile --"] + [p["name"] for p in existing_profiles]
+    profile_names = ["-- New Profile --"] + list(existing_profiles)
     selected_profile = st.selectbox("Load Saved Profile", profile_names)
     
     # DEFAULTS
@@ -65,7 +93,7 @@ with st.sidebar:
     # If a profile is selected, override defaults
     if selected_profile != "-- New Profile --":
         # Find data
-        data = next(p for p in existing_profiles if p["name"] == selected_profile)
+        data = existing_profiles[selected_profile]
         default_dob = datetime.datetime.strptime(data["dob"], "%Y-%m-%d").date()
         t = datetime.datetime.strptime(data["tob"], "%H:%M:%S").time()
         default_tob = t
@@ -84,7 +112,7 @@ with st.sidebar:
     # SAVE BUTTON
     if st.button("💾 Save Profile"):
         if name_input:
-            save_profile(name_input, dob, tob.strftime("%H:%M:%S"), city_name)
+            save_profile(name_input, dob, tob.strftime("%H:%M:%S"), city_name, profiles=existing_profiles)
             st.success(f"Saved {name_input} to Database!")
             time.sleep(1)
             st.rerun()
@@ -102,99 +130,54 @@ with st.sidebar:
         api_key = st.text_input("API Key", type="password")
 
 
-# --- LOGIC: HELPER FUNCTIONS ---
-def get_lat_lon(city):
-    try:
-        geolocator = Nominatim(user_agent="destiny_debugger_v5")
-        location = geolocator.geocode(city)
-        if location:
-            return location.latitude, location.longitude
-    except:
-        return None, None
-    return None, None
-
-def get_zodiac_sign(lon_radians):
-    degrees = math.degrees(lon_radians) % 360
-    zodiacs = ["Aries", "Taurus", "Gemini", "Cancer", "Leo", "Virgo", 
-               "Libra", "Scorpio", "Sagittarius", "Capricorn", "Aquarius", "Pisces"]
-    return zodiacs[int(degrees / 30)], int(degrees / 30)
-
-def calculate_transits(start_date, years, natal_moon_idx):
-    data = []
-    current_date = datetime.datetime.now()
-    end_date = current_date + datetime.timedelta(days=years*365)
-    
-    while current_date < end_date:
-        date_str = current_date.strftime('%Y/%m/%d')
-        
-        t_jupiter = ephem.Jupiter()
-        t_saturn = ephem.Saturn()
-        t_jupiter.compute(date_str)
-        t_saturn.compute(date_str)
-        
-        j_sign, j_idx = get_zodiac_sign(t_jupiter.hlon)
-        s_sign, s_idx = get_zodiac_sign(t_saturn.hlon)
-        
-        score = 0
-        status = "Neutral"
-        
-        if j_idx == natal_moon_idx:
-            score += 2
-            status = "Jupiter Return (Growth)"
-        elif s_idx == natal_moon_idx:
-            score -= 2
-            status = "Saturn Return (Pressure)"
-        
-        if (j_idx - natal_moon_idx) % 4 == 0:
-             score += 1
-             
-        data.append({
-            "Date": current_date,
-            "Energy Score": score,
-            "Jupiter Sign": j_sign,
-            "Saturn Sign": s_sign,
-            "Status": status
-        })
-        current_date += datetime.timedelta(days=30)
-        
-    return pd.DataFrame(data)
+# --- LOGIC: UI HELPERS ---
+CHART_MAX_POINTS = 500
 
-def create_pdf(analysis_text, sun_sign, moon_sign, events):
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", size=12)
-    pdf.cell(200, 10, txt="The Destiny Dossier", ln=True, align='C')
-    pdf.ln(10)
-    pdf.cell(200, 10, txt=f"Profile: Sun in {sun_sign} | Moon in {moon_sign}", ln=True)
-    pdf.ln(5)
-    
-    pdf.set_font("Arial", size=11)
-    clean_text = analysis_text.encode('latin-1', 'replace').decode('latin-1')
-    pdf.multi_cell(0, 10, txt=clean_text)
-    
-    pdf.ln(10)
-    pdf.set_font("Arial", 'B', 12)
-    pdf.cell(200, 10, txt="Strategic Timeline:", ln=True)
-    pdf.set_font("Arial", size=10)
-    
-    for index, row in events.iterrows():
-        date_str = row['Date'].strftime('%Y-%m')
-        line = f"{date_str}: {row['Status']} (Jupiter: {row['Jupiter Sign']})"
-        clean_line = line.encode('latin-1', 'replace').decode('latin-1')
-        pdf.cell(0, 8, txt=clean_line, ln=True)
-        
-    return pdf.output(dest='S').encode('latin-1')
+def rollback_chat_turn():
+    # Drop the pending question from the transcript and its turn from the
+    # session, so both keep the same turns; if the session can't rewind,
+    # both start over
+    st.session_state.messages.pop()
+    chat = st.session_state.chat
+    if chat is not None and not drop_last_turn(chat):
+        st.session_state.chat = None
+        st.session_state.messages = []
 
 def handle_chat_query(query, api_key_val):
+    # Render the new turn in place under the history already on screen,
+    # so a chat turn never needs an st.rerun() of the whole script
     st.session_state.messages.append({"role": "user", "content": query})
-    try:
-        genai.configure(api_key=api_key_val)
-        chat_model = genai.GenerativeModel('gemini-flash-latest')
-        final_prompt = f"{st.session_state.context}\nUSER QUESTION: {query}\nTASK: Answer concisely."
-        response = chat_model.generate_content(final_prompt)
-        st.session_state.messages.append({"role": "assistant", "content": response.text})
-    except Exception as e:
-        st.session_state.messages.append({"role": "assistant", "content": f"Error: {e}"})
+    with st.chat_message("user"):
+        st.markdown(query)
+    
+    if not api_key_val:
+        st.error("Please enter an API Key to chat.")
+        return
+    
+    with st.chat_message("assistant"):
+        with st.spinner("✨ Consulting the Astral Plane..."):
+            try:
+                # One chat session per analysis; later turns send only the question
+                if st.session_state.chat is None:
+                    st.session_state.chat = start_chat(get_model(api_key_val), st.session_state.context)
+                chat = st.session_state.chat
+                
+                # Display result as it streams in
+                bot_reply = st.write_stream(stream_chat(chat, query))
+                
+                stop_reason = chat_stop_reason(chat)
+                if stop_reason is None:
+                    # Save to history
+                    st.session_state.messages.append({"role": "assistant", "content": bot_reply})
+                else:
+                    # A cut-short reply would break the next turn
+                    rollback_chat_turn()
+                    st.warning(f"Gemini stopped this reply early ({stop_reason}), so it was left out of the conversation. Try rephrasing the question.")
+                
+            except Exception as e:
+                # Roll back only the failed turn; earlier turns stay in the session
+                rollback_chat_turn()
+                st.error(f"Error: {e}")
 
 # --- MAIN APP UI ---
 if st.button("Run Analysis"):
@@ -205,82 +188,62 @@ if st.button("Run Analysis"):
             lat, lon = get_lat_lon(city_name)
             if lat:
                 # 1. Calculate Planetary Positions
-                date_str = f"{dob.strftime('%Y/%m/%d')} {tob.strftime('%H:%M:%S')}"
-                obs = ephem.Observer()
-                obs.lat, obs.lon, obs.date = str(lat), str(lon), date_str
-                sun, moon = ephem.Sun(), ephem.Moon()
-                sun.compute(obs)
-                moon.compute(obs)
-                sun_sign, sun_idx = get_zodiac_sign(sun.hlon)
-                moon_sign, moon_idx = get_zodiac_sign(moon.hlon)
+                sun_sign, sun_idx, moon_sign, moon_idx = calculate_natal(dob, tob, lat, lon)
                 
                 # 2. Calculate Transits (The Forward Curve)
-                df = calculate_transits(dob, forecast_years, moon_idx)
-                events = df[df["Energy Score"] != 0].drop_duplicates(subset=["Status"])
+                df, events = calculate_transits(forecast_years, moon_idx)
                 
                 # 3. READ THE KNOWLEDGE BASE (Must happen BEFORE the prompt!)
-                try:
-                    with open("knowledge.txt", "r") as f:
-                        knowledge_base = f.read()
-                except FileNotFoundError:
-                    knowledge_base = "General Vedic Rules apply."
-                
+                knowledge_base = load_knowledge_base()
 
                 # --- 1. GET THE ANCHOR DATE ---
-                today_str = datetime.date.today().strftime("%B %d, %Y")  # e.g., "February 15, 2026"
+                today = datetime.date.today()
+                today_str = today.strftime("%B %d, %Y")  # e.g., "February 15, 2026"
                 
                 # --- 2. CONFIGURE AI & CREATE PROMPT ---
-                genai.configure(api_key=api_key)
-                model = genai.GenerativeModel('gemini-flash-latest')
+                model = get_model(api_key)
                 
                 # --- 3. THE ANCHORED PROMPT ---
-                prompt = f"""
-                ROLE: Act as a strict Vedic Astrologer.
-                
-                --- TIME ANCHOR ---
-                CURRENT DATE: {today_str}
-                FORECAST HORIZON: {forecast_years} Years (From {today_str} onwards)
-                
-                --- KNOWLEDGE BASE ---
-                {knowledge_base}
-                ----------------------
-                
-                SUBJECT DATA:
-                - Sun Sign: {sun_sign}
-                - Moon Sign: {moon_sign}
-                - Upcoming Planetary Shifts: {events['Status'].tolist()}
-                - Shift Dates: {events['Date'].dt.strftime('%Y-%m').tolist()}
-                
-                --- CONSTRAINTS ---
-                1. START the analysis strictly from {today_str}. Do NOT mention 2024 or 2025 unless they are relevant historical context.
-                2. Base predictions ONLY on the provided "Shift Dates."
-                3. DO NOT provide real-world financial data (stocks/crypto).
-                
-                TASK:
-                1. Write an 'Executive Summary' for the period {today_str} to {int(today_str.split(',')[-1]) + forecast_years}.
-                2. Cite specific rules from the Knowledge Base.
-                3. Keep it text-based for PDF compatibility.
-                """
+                prompt = PROMPT_TEMPLATE.format(
+                    today=today_str,
+                    years=forecast_years,
+                    end_year=today.year + forecast_years,
+                    knowledge_base=knowledge_base,
+                    sun_sign=sun_sign,
+                    moon_sign=moon_sign,
+                    shifts="\n".join(
+                        f"  {d}: {s}" for d, s in zip(events['Month'], events['Status'])
+                    ),
+                )
                 
                 try:
-                    # 5. Generate Content
-                    response = model.generate_content(prompt)
-                    analysis_text = response.text
-                    
-                    # Store Context for Chatbot
-                    st.session_state.context = f"CONTEXT: User Sun {sun_sign}, Moon {moon_sign}.\nANALYSIS: {analysis_text}"
-                    
                     # Display Results
                     c1, c2 = st.columns(2)
                     c1.metric("☀️ Sun", sun_sign)
                     c2.metric("🌙 Moon", moon_sign)
-                    st.line_chart(df.set_index("Date")["Energy Score"])
+                    # Send only the plotted columns, capped at CHART_MAX_POINTS
+                    # (ceiling division, so the stride never undershoots the cap)
+                    chart_df = df[["Date", "Energy Score"]]
+                    chart_df = chart_df.iloc[::max(1, -(-len(chart_df) // CHART_MAX_POINTS))]
+                    st.line_chart(chart_df, x="Date", y="Energy Score")
                     st.write("### 🤖 Analysis")
-                    st.write(analysis_text)
                     
-                    # Generate PDF
-                    pdf_bytes = create_pdf(analysis_text, sun_sign, moon_sign, events)
-                    st.download_button("📄 Download PDF", pdf_bytes, "dossier.pdf", "application/pdf")
+                    # 5. Stream Content (tokens render as they arrive)
+                    analysis_text = st.write_stream(stream_text(model, prompt))
+                    
+                    # Store Context for Chatbot
+                    st.session_state.context = f"CONTEXT: User Sun {sun_sign}, Moon {moon_sign}.\nANALYSIS: {analysis_text}"
+                    # A new analysis starts a new conversation, on screen as well
+                    st.session_state.chat = None
+                    st.session_state.messages = []
+                    
+                    # Generate PDF only when the button is clicked; "ignore" keeps
+                    # the click from rerunning the script and clearing the analysis
+                    st.download_button(
+                        "📄 Download PDF",
+                        lambda: create_pdf(analysis_text, sun_sign, moon_sign, events),
+                        "dossier.pdf", "application/pdf", on_click="ignore"
+                    )
                     
                 except Exception as e:
                     st.error(f"Error: {e}")
@@ -317,41 +280,8 @@ if st.session_state.context:
     active_prompt = user_input or st.session_state.chip_prompt
     
     if active_prompt:
-        # A. Display User Message Immediately
-        st.session_state.messages.append({"role": "user", "content": active_prompt})
-        with st.chat_message("user"):
-            st.markdown(active_prompt)
-            
-        # B. Clear the chip prompt so it doesn't fire again
+        # A. Clear the chip prompt so it doesn't fire again
         st.session_state.chip_prompt = None
-
-        # C. The "Thinking" Block
-        if api_key:
-            with st.chat_message("assistant"):
-                # --- THIS IS THE PART YOU ASKED FOR ---
-                with st.spinner("✨ Consulting the Astral Plane..."):
-                    try:
-                        genai.configure(api_key=api_key)
-                        chat_model = genai.GenerativeModel('gemini-flash-latest')
-                        
-                        final_prompt = f"""
-                        {st.session_state.context}
-                        
-                        USER QUESTION: {active_prompt}
-                        
-                        TASK: Answer concisely using the provided context rules.
-                        """
-                        
-                        response = chat_model.generate_content(final_prompt)
-                        bot_reply = response.text
-                        
-                        # Display result
-                        st.markdown(bot_reply)
-                        
-                        # Save to history
-                        st.session_state.messages.append({"role": "assistant", "content": bot_reply})
-                        
-                    except Exception as e:
-                        st.error(f"Error: {e}")
-        else:
-            st.error("Please enter an API Key to chat.")
\ No newline at end of file
+        
+        # B. Display the question and stream the answer in place
+        handle_chat_query(active_prompt, api_key)
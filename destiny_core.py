@@ -0,0 +1,462 @@
+# Shared astrology / AI helpers for the Destiny Dossier UI.
+# Caches live here so they load once per process. The heavy libraries
+# (ephem, pandas, genai, fpdf, geopy) are imported inside the functions
+# that use them, so the first page render doesn't wait on them.
+import streamlit as st
+import math
+import datetime
+import functools
+import hashlib
+import numpy as np
+import json
+import os
+import tempfile
+import threading
+
+# --- AI SETTINGS ---
+GEMINI_MODEL = 'gemini-flash-latest'
+
+# Overall deadline for each Gemini call. Every call streams, and over gRPC the
+# timeout covers the whole streamed response, not just the first token, so it
+# is sized for a long reply to finish; it only stops a truly stalled request
+GEMINI_REQUEST_OPTIONS = {"timeout": 300}
+
+KB_FILE = "knowledge.txt"
+
+# One file per (model, prompt) hash; identical prompts replay from disk.
+# Prompts embed today's date, so the least recently used files are pruned
+RESPONSE_CACHE_DIR = ".gemini_cache"
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+
+# Built once at import; filled with str.format per analysis
+PROMPT_TEMPLATE = """
+ROLE: Act as a strict Vedic Astrologer.
+
+--- TIME ANCHOR ---
+CURRENT DATE: {today}
+FORECAST HORIZON: {years} Years (From {today} onwards)
+
+--- KNOWLEDGE BASE ---
+{knowledge_base}
+----------------------
+
+SUBJECT DATA:
+- Sun Sign: {sun_sign}
+- Moon Sign: {moon_sign}
+- Upcoming Planetary Shifts (Shift Date: Shift):
+{shifts}
+
+--- CONSTRAINTS ---
+1. START the analysis strictly from {today}. Do NOT mention 2024 or 2025 unless they are relevant historical context.
+2. Base predictions ONLY on the provided "Shift Dates."
+3. DO NOT provide real-world financial data (stocks/crypto).
+
+TASK:
+1. Write an 'Executive Summary' for the period {today} to {end_year}.
+2. Cite specific rules from the Knowledge Base.
+3. Keep it text-based for PDF compatibility.
+"""
+
+# --- GEOCODING ---
+GEO_CACHE_FILE = ".geocache.json"
+SEED_CITIES_FILE = "cities.json"
+
+def load_geocache(path=GEO_CACHE_FILE):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError):
+        # A damaged cache file is rebuilt from fresh lookups
+        return {}
+
+def save_geocache(cache):
+    # Compact JSON to a unique temp file, then swap it in atomically, so a
+    # concurrent load_geocache never reads a truncated file as an empty cache
+    directory = os.path.dirname(os.path.abspath(GEO_CACHE_FILE))
+    f = None
+    try:
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=directory,
+                                         suffix=".tmp", delete=False) as f:
+            json.dump(cache, f, separators=(",", ":"))
+        os.replace(f.name, GEO_CACHE_FILE)
+    except OSError:
+        if f is not None:
+            try:
+                os.remove(f.name)
+            except OSError:
+                pass
+        raise
+
+# Common cities ship pre-resolved so they never hit the network
+SEED_CITIES = load_geocache(SEED_CITIES_FILE)
+
+@st.cache_resource(show_spinner=False)
+def get_geolocator():
+    from geopy.adapters import RequestsAdapter
+    from geopy.geocoders import Nominatim
+    # One keep-alive requests.Session pool shared by every lookup; 5 s instead
+    # of geopy's 1 s default so a slow first TLS handshake isn't a miss
+    return Nominatim(
+        user_agent="destiny_debugger_v5",
+        timeout=5,
+        adapter_factory=functools.partial(RequestsAdapter, pool_connections=4, pool_maxsize=4),
+    )
+
+# Only successful lookups are cached: a miss raises, and Streamlit doesn't
+# cache exceptions, so a transient failure can be retried on the next click
+@st.cache_data(ttl=86400, max_entries=512, show_spinner=False)
+def geocode_city(key):
+    if key in SEED_CITIES:
+        return tuple(SEED_CITIES[key])
+    cache = load_geocache()
+    if key in cache:
+        return tuple(cache[key])
+    location = get_geolocator().geocode(key)
+    if not location:
+        raise LookupError(f"No geocoding result for {key!r}")
+    cache[key] = [location.latitude, location.longitude]
+    try:
+        save_geocache(cache)
+    except OSError:
+        # Best effort: a read-only disk still gets the in-memory cache entry
+        pass
+    return location.latitude, location.longitude
+
+def get_lat_lon(city):
+    from geopy.exc import GeocoderServiceError
+    # "Houston, TX " and "houston, tx" share one cache entry.
+    # No result and geocoder/network failures count as a miss
+    try:
+        return geocode_city(city.strip().lower())
+    except (LookupError, GeocoderServiceError):
+        return None, None
+
+# --- ASTROLOGY ---
+ZODIACS = ("Aries", "Taurus", "Gemini", "Cancer", "Leo", "Virgo",
+           "Libra", "Scorpio", "Sagittarius", "Capricorn", "Aquarius", "Pisces")
+STATUS_LABELS = np.array(["Neutral", "Jupiter Return (Growth)", "Saturn Return (Pressure)"])
+
+# 30 degrees per sign: radians * 180/pi / 30
+RAD_TO_SIGN = 6 / math.pi
+# ephem.Date zero point, as a datetime64 for array arithmetic
+DUBLIN_EPOCH = np.datetime64("1899-12-31T12:00")
+
+# Aspect masks: bit n set = aspect when the planet is n signs past the natal Moon
+JUPITER_ASPECTS = (1 << 0) | (1 << 4) | (1 << 8)  # conjunction + both trines
+
+def aspect_hits(planet_idx, natal_idx, mask):
+    offset = ((planet_idx - natal_idx) % 12).astype(np.int16)
+    return ((1 << offset) & mask) != 0
+
+# Transit scoring: heliocentric longitudes -> sign indices -> scores.
+# +2 Jupiter Return, -2 Saturn Return (Jupiter takes precedence), +1
+# Jupiter aspect. Status codes index STATUS_LABELS: 0 Neutral, 1 Jupiter,
+# 2 Saturn. Both versions return (j_idx, s_idx, score, code).
+def score_transits_numpy(j_hlon, s_hlon, natal_moon_idx):
+    j_idx = (j_hlon * RAD_TO_SIGN).astype(np.int8) % 12
+    s_idx = (s_hlon * RAD_TO_SIGN).astype(np.int8) % 12
+    jr = j_idx == natal_moon_idx
+    sr = (s_idx == natal_moon_idx) & ~jr
+    tr = aspect_hits(j_idx, natal_moon_idx, JUPITER_ASPECTS)
+    score = (2 * jr.astype(np.int8) - 2 * sr + tr).astype(np.int8)
+    code = (jr + 2 * sr).astype(np.int8)
+    return j_idx, s_idx, score, code
+
+def score_transits_loop(j_hlon, s_hlon, natal_moon_idx):
+    n = j_hlon.size
+    j_idx = np.empty(n, np.int8)
+    s_idx = np.empty(n, np.int8)
+    score = np.empty(n, np.int8)
+    code = np.empty(n, np.int8)
+    for i in range(n):
+        j = int(j_hlon[i] * RAD_TO_SIGN) % 12
+        s = int(s_hlon[i] * RAD_TO_SIGN) % 12
+        sc = 0
+        c = 0
+        if j == natal_moon_idx:
+            sc += 2
+            c = 1
+        elif s == natal_moon_idx:
+            sc -= 2
+            c = 2
+        if (JUPITER_ASPECTS >> ((j - natal_moon_idx) % 12)) & 1:
+            sc += 1
+        j_idx[i] = j
+        s_idx[i] = s
+        score[i] = sc
+        code[i] = c
+    return j_idx, s_idx, score, code
+
+# The NumPy kernel scores a 20-year horizon in well under a millisecond, while
+# importing and compiling (or cache-loading) numba costs ~0.4-0.7 s per process,
+# so the JIT loop is opt-in: set DESTINY_USE_NUMBA=1 to use it
+USE_NUMBA = os.environ.get("DESTINY_USE_NUMBA") == "1"
+
+@st.cache_resource
+def get_score_kernel():
+    if not USE_NUMBA:
+        return score_transits_numpy
+    try:
+        from numba import njit
+    except ImportError:
+        return score_transits_numpy
+    return njit(cache=True)(score_transits_loop)
+
+def get_zodiac_sign(lon_radians):
+    idx = int(lon_radians * RAD_TO_SIGN) % 12
+    return ZODIACS[idx], idx
+
+@st.cache_data
+def calculate_natal(dob, tob, lat, lon):
+    import ephem
+    date_str = f"{dob.strftime('%Y/%m/%d')} {tob.strftime('%H:%M:%S')}"
+    obs = ephem.Observer()
+    obs.lat, obs.lon, obs.date = str(lat), str(lon), date_str
+    sun, moon = ephem.Sun(), ephem.Moon()
+    sun.compute(obs)
+    moon.compute(obs)
+    sun_sign, sun_idx = get_zodiac_sign(sun.hlon)
+    moon_sign, moon_idx = get_zodiac_sign(moon.hlon)
+    return sun_sign, sun_idx, moon_sign, moon_idx
+
+# Keyed on the inputs only; the ttl rolls the "from today" start date forward
+@st.cache_data(ttl=3600)
+def calculate_transits(years, natal_moon_idx):
+    import ephem
+    import pandas as pd
+    # One sample every 30 days from today across the horizon
+    start = np.datetime64(datetime.date.today(), 'D')
+    end = start + np.timedelta64(years * 365, 'D')
+    dates = np.arange(start, end, np.timedelta64(30, 'D'))
+    
+    # ephem epochs are Dublin Julian Days (days since 1899-12-31 12:00 UTC),
+    # so the whole array converts in one vectorized subtraction
+    epochs = (dates - DUBLIN_EPOCH) / np.timedelta64(1, 'D')
+    
+    # Reuse the planet objects; only .compute() runs per date
+    t_jupiter = ephem.Jupiter()
+    t_saturn = ephem.Saturn()
+    j_hlon = np.empty(len(epochs), dtype=np.float64)
+    s_hlon = np.empty(len(epochs), dtype=np.float64)
+    for i, epoch in enumerate(epochs.tolist()):
+        t_jupiter.compute(epoch)
+        t_saturn.compute(epoch)
+        j_hlon[i] = t_jupiter.hlon
+        s_hlon[i] = t_saturn.hlon
+    
+    j_idx, s_idx, score, code = get_score_kernel()(j_hlon, s_hlon, natal_moon_idx)
+    # Events: the first sample of each run of scored months sharing a status
+    run = np.where(score != 0, code, -1)
+    change = np.concatenate(([True], run[1:] != run[:-1]))
+    events_idx = np.flatnonzero(change & (score != 0))
+    
+    # Columns go in as typed arrays; signs and status stay int8 categoricals
+    df = pd.DataFrame({
+        "Date": dates,
+        "Energy Score": score,
+        "Jupiter Sign": pd.Categorical.from_codes(j_idx, ZODIACS),
+        "Saturn Sign": pd.Categorical.from_codes(s_idx, ZODIACS),
+        "Status": pd.Categorical.from_codes(code, STATUS_LABELS)
+    })
+    # Month labels are formatted once here for both the prompt and the PDF
+    events = df.iloc[events_idx]
+    events = events.assign(Month=events['Date'].dt.strftime('%Y-%m'))
+    return df, events
+
+# --- PDF EXPORT ---
+# fpdf2 embeds these bundled TTFs so Gemini's em-dashes and smart quotes
+# survive; if they go missing the PDF falls back to a latin-1 core font
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+PDF_FONT_FILES = {
+    "": os.path.join(FONT_DIR, "DejaVuSans.ttf"),
+    "B": os.path.join(FONT_DIR, "DejaVuSans-Bold.ttf"),
+}
+
+# Runs off the script thread when Download is clicked, hence no spinner;
+# memoized so repeat downloads of the same analysis reuse the bytes
+@st.cache_data(show_spinner=False, max_entries=16)
+def create_pdf(analysis_text, sun_sign, moon_sign, events):
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.add_page()
+    unicode_font = all(os.path.exists(path) for path in PDF_FONT_FILES.values())
+    if unicode_font:
+        for style, path in PDF_FONT_FILES.items():
+            pdf.add_font("DejaVu", style, path)
+    font = "DejaVu" if unicode_font else "Helvetica"
+    
+    def clean(text):
+        # Core fonts are latin-1 only; the TTF takes the text as-is
+        return text if unicode_font else text.encode('latin-1', 'replace').decode('latin-1')
+    
+    pdf.set_font(font, size=12)
+    pdf.cell(200, 10, text="The Destiny Dossier", new_x="LMARGIN", new_y="NEXT", align='C')
+    pdf.ln(10)
+    pdf.cell(200, 10, text=clean(f"Profile: Sun in {sun_sign} | Moon in {moon_sign}"), new_x="LMARGIN", new_y="NEXT")
+    pdf.ln(5)
+    
+    pdf.set_font(font, size=11)
+    pdf.multi_cell(0, 10, text=clean(analysis_text), new_x="LMARGIN", new_y="NEXT")
+    
+    pdf.ln(10)
+    pdf.set_font(font, 'B', 12)
+    pdf.cell(200, 10, text="Strategic Timeline:", new_x="LMARGIN", new_y="NEXT")
+    pdf.set_font(font, size=10)
+    
+    # Format the whole timeline column-wise and emit it as one 8 mm-per-line block
+    lines = (events['Month'] + ": " + events['Status'].astype(str)
+             + " (Jupiter: " + events['Jupiter Sign'].astype(str) + ")").tolist()
+    pdf.multi_cell(0, 8, text=clean("\n".join(lines)), new_x="LMARGIN", new_y="NEXT")
+        
+    return bytes(pdf.output())
+
+# --- AI CLIENT ---
+@st.cache_resource(show_spinner=False)
+def load_knowledge_base():
+    try:
+        with open(KB_FILE, "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return "General Vedic Rules apply."
+
+def hash_secret(value):
+    # bytes, not str: Streamlit re-hashes the result with the same hash_funcs
+    return hashlib.sha256(value.encode("utf-8")).digest()
+
+# genai.configure() swaps process-wide state, so keys are applied one at a time
+GENAI_CONFIG_LOCK = threading.Lock()
+
+# Cache entries are keyed by a digest of the arguments, never the raw API key.
+# Each entry holds its own gRPC client, so only the most recent keys are kept;
+# an evicted model's channel closes once no chat session still references it
+@st.cache_resource(show_spinner=False, hash_funcs={str: hash_secret}, max_entries=8)
+def get_model(api_key_val, name=GEMINI_MODEL):
+    import google.generativeai as genai
+    from google.generativeai import client as genai_client
+    # A model binds the default client lazily on its first request, so bind it
+    # here while this key is configured; a later configure() for another key
+    # then can't redirect this cached model's calls.
+    # NOTE: GenerativeModel._client is SDK-internal; this relies on
+    # google-generativeai 0.8.x (pinned to 0.8.6 in requirements.txt), and the
+    # package is no longer maintained, so recheck before any upgrade
+    with GENAI_CONFIG_LOCK:
+        genai.configure(api_key=api_key_val)
+        model = genai.GenerativeModel(name)
+        model._client = genai_client.get_default_generative_client()
+    return model
+
+def response_cache_path(model_name, prompt):
+    key = hashlib.sha256(f"{model_name}\n{prompt}".encode("utf-8")).hexdigest()
+    return os.path.join(RESPONSE_CACHE_DIR, f"{key}.txt")
+
+def iter_text(response):
+    # A trailing finish-reason-only chunk has no parts and its .text raises;
+    # .parts itself still raises for a blocked prompt (no candidates)
+    empty = True
+    for chunk in response:
+        if not chunk.parts:
+            continue
+        empty = False
+        yield chunk.text
+    if empty:
+        raise ValueError("Gemini returned no text for this request.")
+
+def store_response(path, text):
+    # Write-then-rename so a concurrent reader never sees a half-written reply;
+    # a failed write removes its temp file, which pruning would never count
+    os.makedirs(RESPONSE_CACHE_DIR, exist_ok=True)
+    f = None
+    try:
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=RESPONSE_CACHE_DIR,
+                                         suffix=".tmp", delete=False) as f:
+            f.write(text)
+        os.replace(f.name, path)
+    except OSError:
+        if f is not None:
+            try:
+                os.remove(f.name)
+            except OSError:
+                pass
+        raise
+    
+    # Hits refresh their mtime, so the oldest files are the least recently used
+    entries = [e for e in os.scandir(RESPONSE_CACHE_DIR) if e.name.endswith(".txt")]
+    if len(entries) > RESPONSE_CACHE_MAX_ENTRIES:
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries[:len(entries) - RESPONSE_CACHE_MAX_ENTRIES]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass  # already pruned by another session
+
+def stream_text(model, prompt):
+    # The prompt already embeds the full context, so it is the whole key.
+    # A stored reply is replayed in one chunk; otherwise stream from Gemini
+    # and store the reply only if it finished normally
+    path = response_cache_path(model.model_name, prompt)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            cached = f.read()
+    except OSError:
+        cached = None  # missing or unreadable: ask Gemini instead
+    if cached is not None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass  # pruned meanwhile; the text is already in hand
+        yield cached
+        return
+    
+    response = model.generate_content(prompt, stream=True, request_options=GEMINI_REQUEST_OPTIONS)
+    chunks = []
+    for text in iter_text(response):
+        chunks.append(text)
+        yield text
+    
+    # Replies cut short (SAFETY, MAX_TOKENS, RECITATION) still stream text;
+    # only a STOP finish is a complete reply worth replaying
+    if response.candidates and response.candidates[0].finish_reason.name == "STOP":
+        try:
+            store_response(path, "".join(chunks))
+        except OSError:
+            # Best effort, like the geocache: the reply is already on screen
+            pass
+
+def start_chat(model, context):
+    # The analysis context opens the history once instead of being pasted
+    # into every question; the model turn keeps the roles alternating
+    return model.start_chat(history=[
+        {"role": "user", "parts": [f"{context}\n\nTASK: Answer my questions concisely using the provided context rules."]},
+        {"role": "model", "parts": ["Understood. Ask me anything about this chart."]},
+    ])
+
+def stream_chat(chat, message):
+    # Chat turns depend on the running history, so they bypass the response cache
+    response = chat.send_message(message, stream=True, request_options=GEMINI_REQUEST_OPTIONS)
+    yield from iter_text(response)
+
+# Finish reasons ChatSession.history accepts; after any other (SAFETY,
+# RECITATION, ...) the next send_message raises BrokenResponseError
+CHAT_COMPLETE_REASONS = ("FINISH_REASON_UNSPECIFIED", "STOP", "MAX_TOKENS")
+
+def chat_stop_reason(chat):
+    # None when the last streamed reply can stay in the history
+    candidates = chat.last.candidates
+    if not candidates:
+        return "NO_CANDIDATES"
+    reason = candidates[0].finish_reason.name
+    return None if reason in CHAT_COMPLETE_REASONS else reason
+
+def drop_last_turn(chat):
+    # chat.last is None when the request failed before a response was
+    # recorded; rewind() would then pop the previous, good turn instead.
+    # False means the turn can't be rewound (no candidate came back)
+    if chat.last is None:
+        return True
+    try:
+        chat.rewind()
+    except IndexError:
+        return False
+    return True